@@ -6,34 +6,71 @@
 #
 
 import argparse
-from bs4 import BeautifulSoup
-import pickle
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+import io
+import json
+import logging
+import lxml.etree
+import lxml.html
 import re
-from typing import Dict, List
-import urllib.request
+import requests
+from requests.adapters import HTTPAdapter
+import sys
+from typing import Dict, Optional, Tuple
 
 # Constants
 GRIM_DAWN_BASE = "https://grimdawn.fandom.com"
 GRIM_DAWN_WIKI = "https://grimdawn.fandom.com/wiki/Blueprints"
 LOCAL_DB = "./blue.prints"
-REGEX_INGREDIENT = r"([^(]*)\((\d+)\)"
+DOWNLOAD_WORKERS = 24
+DOWNLOAD_TIMEOUT = 10
+JSON_SEPARATORS = ( ",", ":" )
+REGEX_INGREDIENT = re.compile( r"([^(]*)\((\d+)\)" )
+REGEX_CRAFTS = re.compile( r"crafts", re.IGNORECASE )
+
+logger = logging.getLogger( "grimmeroo" )
 
 # Classes
+class InvalidDatabaseError( ValueError ):
+    """ Raised when the local DB exists but does not contain valid blueprint data """
+
+
 class Blueprint:
+    __slots__ = ( "name", "type", "materials" )
+
     def __init__( self ):
         self.name = ""
         self.type = ""
         self.materials = {}
 
-    def materials_list( self ) -> List[ str ]:
-        """ Returning a list of all the components with items repeated by their quantity
+    def to_dict( self ) -> Dict[ str, object ]:
+        """ Converting the blueprint into plain data, ready to be stored
 
-        :return: The list of materials
-        :rtype: List[ str ]
+        :return: Mapping with name, type and materials of the blueprint
+        :rtype: Dict[ str, object ]
         """
 
-        result = [ [ mat ] * qty for mat, qty in self.materials.items() ]
-        return [ sublist for l in result for sublist in l ]
+        return { "name": self.name, "type": self.type, "materials": self.materials }
+
+    @classmethod
+    def from_dict( cls,
+                   data: Dict[ str, object ] ) -> "Blueprint":
+        """ Creating a blueprint from the plain data produced by to_dict
+
+        :param data: Mapping with name, type and materials of the blueprint
+        :type: Dict[ str, object ]
+        :return: The created Blueprint instance
+        :rtype: Blueprint
+        """
+
+        result = cls()
+        # Names are interned as they are repeated across blueprints and used as lookup keys
+        result.name = sys.intern( data[ "name" ] )
+        result.type = data.get( "type", "" )
+        result.materials = { sys.intern( k ): v for k, v in data[ "materials" ].items() }
+        return result
 
     def __str__( self ):
         return "{}({}) [{}]".format( self.name,
@@ -46,14 +83,77 @@ class Blueprint:
 
 class Blueprints:
     def __init__( self ):
-        self.blueprints = {}
+        # Fully expanded raw materials of each blueprint, filled on demand
+        self._expanded = {}
+        # Lowercase blueprint names paired with the original ones, built on demand
+        self._lower_names = None
+        # Single keep-alive pool shared by all the download threads
+        self.session = requests.Session()
+        self.session.mount( "https://", HTTPAdapter( pool_connections=1,
+                                                     pool_maxsize=DOWNLOAD_WORKERS ) )
+
+    @cached_property
+    def blueprints( self ) -> Dict[ str, Blueprint ]:
+        """ Blueprints database, loaded from the local DB (or the wiki) on first access
+
+        :return: Mapping between blueprint names and Blueprint instances
+        :rtype: Dict[ str, Blueprint ]
+        """
+
+        return self._load()
+
+    def _load( self ) -> Dict[ str, Blueprint ]:
+        """ Loading the local DB, downloading it from the wiki if missing
+
+        :return: Mapping between blueprint names and Blueprint instances
+        :rtype: Dict[ str, Blueprint ]
+        :raises InvalidDatabaseError: If the local DB cannot be read as a blueprint DB
+        """
+
         try:
-            self.blueprints = pickle.load( open( LOCAL_DB, "rb" ) )
+            # Plain JSON data, so that loading a DB can never execute code
+            with open( LOCAL_DB, "rb" ) as input_file:
+                db_content = input_file.read()
+            result = {}
+            try:
+                for data in json.loads( db_content ):
+                    blueprint = Blueprint.from_dict( data )
+                    result[ blueprint.name ] = blueprint
+            except ( ValueError, KeyError, TypeError, AttributeError ) as error:
+                # Older versions stored the DB as a pickle, which is never loaded anymore
+                raise InvalidDatabaseError( "Local DB '{}' is not a valid blueprint DB (an old pickle DB?): "
+                                            "delete it to download the blueprints again".format( LOCAL_DB ) ) from error
+            return result
         except FileNotFoundError:
             print( "Local DB not found, downloading from Grim Dawn wiki: {}".format( GRIM_DAWN_WIKI ) )
-            self.read_all_blueprints( GRIM_DAWN_WIKI )
+            result = {}
+            self.read_all_blueprints( GRIM_DAWN_WIKI, result )
+            # Encoded in memory first, as json.dump would issue a write for every chunk
+            db_content = json.dumps( [ b.to_dict() for b in result.values() ],
+                                     separators=JSON_SEPARATORS )
             with open( LOCAL_DB, "wb" ) as output_file:
-                pickle.dump( self.blueprints, output_file )
+                output_file.write( db_content.encode( "utf-8" ) )
+            return result
+
+    def _download( self,
+                   link: str ) -> Tuple[ bytes, Optional[ str ] ]:
+        """ Downloading the content of the given page
+
+        :param link: Link to the page
+        :type: str
+        :return: Raw content of the page and its charset, if declared by the HTTP headers
+        :rtype: Tuple[ bytes, Optional[ str ] ]
+        :raises requests.HTTPError: If the server answers with an error status
+        """
+
+        response = self.session.get( link, timeout=DOWNLOAD_TIMEOUT )
+        # Error pages (e.g. rate limiting) must never be parsed as blueprints
+        response.raise_for_status()
+        # requests falls back to latin-1 for any text page, so its encoding is only
+        # trusted when the server actually declared it, otherwise lxml reads it from the page
+        if "charset" in response.headers.get( "content-type", "" ).lower():
+            return response.content, response.encoding
+        return response.content, None
 
     def create_blueprint( self,
                           link: str,
@@ -68,48 +168,86 @@ class Blueprints:
         :rtype: Blueprint
         """
     
-        current_content = BeautifulSoup( urllib.request.urlopen( link ).read(), # open( link, "r" ),  
-                                         "html.parser" )
+        current_content, encoding = self._download( link ) # open( link, "rb" ).read(), None
+
+        # Only the first title and the first table are needed, so the parsing stops
+        # as soon as both are complete instead of building the whole page
+        blueprint_info = None
+        first_table = None
+        ingredients = None
+        for event, element in lxml.etree.iterparse( io.BytesIO( current_content ),
+                                                    events=( "start", "end" ),
+                                                    tag=( "h1", "table" ),
+                                                    html=True,
+                                                    encoding=encoding ):
+            if event == "start":
+                if element.tag == "table" and first_table is None:
+                    first_table = element
+            elif element.tag == "h1" and blueprint_info is None:
+                blueprint_info = element.xpath( "string()" )
+            elif element is first_table:
+                ingredients = element.xpath( ".//td[ normalize-space() ]" )
+
+            if blueprint_info is not None and ingredients is not None:
+                break
+
+        if blueprint_info is None:
+            raise ValueError( "No title found in blueprint page '{}'".format( link ) )
+        if ingredients is None:
+            raise ValueError( "No ingredients table found in blueprint page '{}'".format( link ) )
     
         result = Blueprint()
-        blueprint_info = current_content.find_all( "h1" )[ 0 ].text
         result.name = blueprint_info.replace( "Blueprint: ", "" )
-        result.name = result.name.replace( "Relic - ", "" )
+        result.name = sys.intern( result.name.replace( "Relic - ", "" ) )
         if item_type is not None:
             result.type = item_type 
     
-        ingredients = current_content.find_all( "table" )[ 0 ].find_all( "td" )
-        ingredients = [ i for i in ingredients if i.text ]
         for ingredient in ingredients:
-            if "crafts" in ingredient.text.lower():
+            ingredient_text = ingredient.xpath( "string()" )
+            if REGEX_CRAFTS.search( ingredient_text ):
                 break
-            print( "\t- '{}'".format( ingredient.text ) )
-            current_ingredient = re.findall( REGEX_INGREDIENT, ingredient.text )
+            logger.debug( "\t- '%s'", ingredient_text )
+            current_ingredient = REGEX_INGREDIENT.findall( ingredient_text )
             if len( current_ingredient ) > 0:
-                result.materials[ current_ingredient[ 0 ][ 0 ][ :-1 ] ] = int( current_ingredient[ 0 ][ 1 ] )
+                result.materials[ sys.intern( current_ingredient[ 0 ][ 0 ][ :-1 ] ) ] = int( current_ingredient[ 0 ][ 1 ] )
     
         return result
     
     def read_all_blueprints( self,
-                             link: str ) -> int:
+                             link: str,
+                             blueprints: Dict[ str, Blueprint ] ) -> int:
         """ Reading info of all blueprints from the given link (Wiki)
     
         :param link: Link to the Grim Dawn blueprint list
         :type: str
-        :return: The number of created Blueprint list
+        :param blueprints: Mapping to fill with the created blueprints
+        :type: Dict[ str, Blueprint ]
+        :return: The number of blueprints in the filled mapping
         :rtype: int
         """
     
-        page_content = BeautifulSoup( urllib.request.urlopen( GRIM_DAWN_WIKI ).read(),
-                                      "html.parser" )
+        page_content, encoding = self._download( link )
+        page_content = lxml.html.fromstring( page_content,
+                                             parser=lxml.html.HTMLParser( encoding=encoding ) )
         
-        blueprints = [ link for link in page_content.find_all( "a" )
-                            if "blueprint:" in link.text.lower() ]
+        anchors = [ anchor for anchor in page_content.iter( "a" )
+                           if "blueprint:" in anchor.text_content().lower() ]
 
-        print( "{} blueprints found".format( len( blueprints ) ) )
-        for blueprint in blueprints:
-            print( " - Analysing '{}'".format( blueprint ) )
-            self.add_blueprint( self.create_blueprint( GRIM_DAWN_BASE + blueprint.get( "href" ) ) )
+        logger.debug( "%d blueprints found", len( anchors ) )
+        urls = [ GRIM_DAWN_BASE + anchor.get( "href" ) for anchor in anchors ]
+        previous_names = set( blueprints )
+        names = []
+        # Pages are fetched concurrently, while the DB is only updated from this thread
+        with ThreadPoolExecutor( max_workers=DOWNLOAD_WORKERS ) as executor:
+            for url, blueprint in zip( urls, executor.map( self.create_blueprint, urls ) ):
+                logger.debug( " - Analysed '%s'", url )
+                names.append( blueprint.name )
+                blueprints[ blueprint.name ] = blueprint
+
+        # Duplicates are reported once the whole DB has been built
+        for name, count in Counter( names ).items():
+            if count > 1 or name in previous_names:
+                print( "WARNING! '{}' seems to already be part of the DB!".format( name ) )
 
         #   titles = [ t for t in page_content.find_all( "h2" )
         #              if "blueprint" in t.text.lower() ]
@@ -124,22 +262,8 @@ class Blueprints:
         #                                                      item_type ) )
         
     
-        return len( self.blueprints )
-
-    def add_blueprint( self,
-                       blueprint: Blueprint ) -> None:
-        """ Adding the blueprint
-
-        :param blueprint: Blueprint instance to add
-        :type: Blueprint
-        :return: None
-        :rtype: None
-        """
+        return len( blueprints )
 
-        if blueprint.name in self.blueprints:
-            print( "WARNING! '{}' seems to already be part of the DB!" )
-        self.blueprints[ blueprint.name ] = blueprint
-    
     def find_keyword( self,
                       keyword: str ) -> Dict[ str, Dict[ str, int ] ]:
         """ Finding all materials needed to craft a particular item given by a keyword
@@ -152,28 +276,47 @@ class Blueprints:
         :rtype: Dict[ str, Dict[ str, int ] ]
         """
     
-        blueprint_matches = [ k for k in self.blueprints.keys() if keyword.lower() in k.lower() ]
-        return { k: pack_list( self.find_materials( k ) ) for k in blueprint_matches }
+        if self._lower_names is None:
+            self._lower_names = [ ( k.lower(), k ) for k in self.blueprints.keys() ]
+
+        keyword = keyword.lower()
+        blueprint_matches = [ k for lower_k, k in self._lower_names if keyword in lower_k ]
+        return { k: self.find_materials( k ) for k in blueprint_matches }
     
     
     def find_materials( self,
-                        item_name: str ) -> List[ str ]:
+                        item_name: str ) -> Dict[ str, int ]:
         """ Finding the materials needed for a given blueprint
     
         :param item_name: Blueprint to analyse
         :type: str
-        :return: List of raw materials needed to craft the given blueprint
-        :rtype: List[ str ]
+        :return: Mapping between raw materials needed to craft the given blueprint and their quantities
+        :rtype: Dict[ str, int ]
         """
     
-        result = self.blueprints[ item_name ].materials_list()
-        to_remove = []
-        for idx, material in enumerate( result ):
-            if material in self.blueprints:
-                result.extend( self.blueprints[ material ].materials_list() )
-                to_remove.append( idx )
+        return Counter( self._expand_materials( item_name ) )
+
+    def _expand_materials( self,
+                           item_name: str ) -> Counter:
+        """ Expanding a blueprint into its raw materials, reusing the expansions already computed
+
+        :param item_name: Blueprint to expand
+        :type: str
+        :return: Cached mapping between raw materials and their quantities, not to be modified
+        :rtype: Counter
+        """
 
-        return [ result[ i ] for i in range( len( result ) ) if i not in to_remove ]
+        if item_name not in self._expanded:
+            result = Counter()
+            for material, qty in self.blueprints[ item_name ].materials.items():
+                if material in self.blueprints:
+                    for sub_material, sub_qty in self._expand_materials( material ).items():
+                        result[ sub_material ] += sub_qty * qty
+                else:
+                    result[ material ] += qty
+            self._expanded[ item_name ] = result
+
+        return self._expanded[ item_name ]
 
     def size( self ) -> int:
         """ Return the number of blueprints stored
@@ -184,18 +327,6 @@ class Blueprints:
 
         return len( self.blueprints )
 
-# Functions
-def pack_list( a_list: List[ str ] ) -> Dict[ str, int ]:
-    """ Packing a list of repeated items into a dictionary
-
-    :param a_list: A list to pack
-    :type: List[ str ]
-    :return: Mapping between value and quantity of the items in the list
-    :rtype: Dict[ str, int ]
-    """
-
-    return { k: a_list.count( k ) for k in set( a_list ) }
-
 # Main
 def main():
     #   sbra = create_blueprint( "./Blueprint_Maivens_Lens.html" )
@@ -208,13 +339,26 @@ def main():
                              default=None,
                              type=str,
                              help="Keywork for the blueprint of interest" )
+    arg_parser.add_argument( "--verbose",
+                             dest="verbose",
+                             action="store_true",
+                             help="Print the progress of the blueprints download" )
 
     input_args = vars( arg_parser.parse_args() )
+    logging.basicConfig( format="%(message)s",
+                         level=logging.WARNING )
+    # Only this script becomes verbose, not the libraries it relies on (e.g. urllib3)
+    if input_args[ "verbose" ]:
+        logger.setLevel( logging.DEBUG )
 
 
     if input_args[ "keyword" ] is not None:
         blueprints = Blueprints()
-        print( "Database of {} Blueprints loaded".format( blueprints.size() ) )
+        try:
+            print( "Database of {} Blueprints loaded".format( blueprints.size() ) )
+        except InvalidDatabaseError as error:
+            print( error, file=sys.stderr )
+            sys.exit( 1 )
     
         for blueprint, materials in blueprints.find_keyword( input_args[ "keyword" ] ).items():
             print( "'{}':\n{}".format( blueprint, "\n".join( " - {} {}".format( v, k ) for k, v in materials.items() ) ) )